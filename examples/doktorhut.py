@@ -1,10 +1,14 @@
 #!/usr/bin/env python
 
-import glob
+import functools
+import gc
+import logging
 import os
 import re
-import signal
+import threading
 import time
+import wave
+from concurrent.futures import ThreadPoolExecutor
 from sys import exit
 
 try:
@@ -15,15 +19,20 @@ except ImportError:
 import pianohat
 
 
+# Keypress handlers log at DEBUG so the default WARNING level keeps
+# stdout writes (slow on a serial tty) out of the audio-latency path.
+log = logging.getLogger(__name__)
+
+
 # Soundbank path
 BANK = os.path.join(os.path.dirname(__file__), "sounds")
 
 
 # A little dictionary of melodies, to be used by MelodyMode.
 melodies = {
-  'alle_meine_entchen': [0,2,4,5,7,7,9,9,9,9,7,9,9,9,9,7,5,5,5,5,4,4,2,2,2,2,0],
-  'twinkle_twinkle': [0,0,7,7,9,9,7,5,5,4,4,2,2,0],
-  'zeiss': [7,9,7,7,7,7,5,4,0],
+  'alle_meine_entchen': (0,2,4,5,7,7,9,9,9,9,7,9,9,9,9,7,5,5,5,5,4,4,2,2,2,2,0),
+  'twinkle_twinkle': (0,0,7,7,9,9,7,5,5,4,4,2,2,0),
+  'zeiss': (7,9,7,7,7,7,5,4,0),
 }
 
 
@@ -35,32 +44,67 @@ Press Ctrl+C to exit
 
 # Settings and vars for the piano
 NOTE_OFFSET = -9
-FILETYPES = ['*.wav', '*.ogg']
+# Mixer buffer size in samples. Smaller means less key-to-sound latency,
+# at a slight risk of underruns. 256 is fine for short one-shot samples.
+BUFFER_SAMPLES = 256
+# Recognised sample formats; extend with e.g. '.flac' as needed.
+SUFFIXES = frozenset({'.wav', '.ogg'})
 samples = []
 files = []
 octaves = 0
 opmode_index = 0
-
-
-def turn_off_leds():
-    for led in range(16):
-       pianohat.set_led(led, False)
-
-
-def natural_sort_key(s, _nsre=re.compile('([0-9]+)')):
-    return [int(text) if text.isdigit() else text.lower() for text in re.split(_nsre, s)]
+# One mixer channel per key, filled in after mixer init. Playing through a
+# fixed channel skips SDL's free-channel search and lets a re-pressed key
+# cut itself off instead of stacking.
+CHANNELS = []
+
+
+# With a capturing group, re.split puts the digit runs at the odd indices,
+# so index parity replaces a per-token isdigit() check.
+_NSRE = re.compile('([0-9]+)')
+
+
+# Memoized (returning a hashable tuple) so the regex split runs once per
+# unique filename, even when the samples are reloaded.
+@functools.lru_cache(maxsize=None)
+def natural_sort_key(s):
+    return tuple(int(text) if i & 1 else text.lower() for i, text in enumerate(_NSRE.split(s)))
+
+
+def load_sample(path):
+    # .wav files already in the mixer's output format are read straight
+    # into a raw PCM buffer, bypassing SDL's loader and converter. Anything
+    # else (.ogg, or a mismatched wav) goes through the regular loader,
+    # which converts as needed.
+    if path.endswith('.wav'):
+        try:
+            with wave.open(path, 'rb') as wav:
+                frequency, size, channels = pygame.mixer.get_init()
+                if (wav.getframerate() == frequency
+                        and wav.getsampwidth() * 8 == abs(size)
+                        and wav.getnchannels() == channels):
+                    return pygame.mixer.Sound(buffer=wav.readframes(wav.getnframes()))
+        except wave.Error:
+            pass
+    return pygame.mixer.Sound(path)
 
 
 def load_samples():
     global samples, files, octaves
-    files = []
     base_path = os.path.join(BANK, 'piano')
     print('Loading samples from {}'.format(base_path))
-    for filetype in FILETYPES:
-        files.extend(glob.glob(os.path.join(base_path, filetype)))
+    with os.scandir(base_path) as it:
+        files = [entry.path for entry in it
+                 if os.path.splitext(entry.name)[1].lower() in SUFFIXES]
     files.sort(key=natural_sort_key)
     octaves = len(files) // 12
-    samples = [pygame.mixer.Sound(sample) for sample in files]
+    if files:
+        # Sound releases the GIL while decoding, so a thread pool spreads
+        # the startup decode across cores. map preserves file order.
+        with ThreadPoolExecutor(max_workers=min(8, len(files))) as executor:
+            samples = list(executor.map(load_sample, files))
+    else:
+        samples = []
 
 
 # Pressing 'instrument' will cycle through the modes. All modes
@@ -74,15 +118,36 @@ def handle_instrument(channel, pressed):
         opmodes[opmode_index].activate()
 
 
+# Permanent dispatchers, registered once at startup. Switching modes only
+# moves opmode_index instead of re-registering three callbacks per switch.
+# A buggy handler is logged rather than left to unwind through the
+# pianohat callback thread on every press.
+def dispatch_note(channel, pressed):
+    try:
+        opmodes[opmode_index].handle_note(channel, pressed)
+    except Exception:
+        log.exception('Error in %s handle_note', opmodes[opmode_index].name)
+
+
+def dispatch_octave_up(channel, pressed):
+    try:
+        opmodes[opmode_index].handle_octave_up(channel, pressed)
+    except Exception:
+        log.exception('Error in %s handle_octave_up', opmodes[opmode_index].name)
+
+
+def dispatch_octave_down(channel, pressed):
+    try:
+        opmodes[opmode_index].handle_octave_down(channel, pressed)
+    except Exception:
+        log.exception('Error in %s handle_octave_down', opmodes[opmode_index].name)
+
+
 class PianoMode:
     auto_led = True
 
     def activate(self):
-        pianohat.on_note(self.handle_note)
-        pianohat.on_octave_up(self.handle_octave_up)
-        pianohat.on_octave_down(self.handle_octave_down)
-        for x in range(16):
-            pianohat.set_led(x, False)
+        pianohat.clear_leds()
         pianohat.auto_leds(self.auto_led)
 
     def handle_note(self, channel, pressed):
@@ -105,22 +170,33 @@ class SimplePianoMode(PianoMode):
         else:
             print('Impossible starting octave. Initializing with 0.')
             self.octave = 0
+        self._build_sample_map()
+
+    def _build_sample_map(self):
+        # Per-key Sound references for the current octave, so handle_note
+        # is a single tuple index instead of arithmetic, bounds checks and
+        # a list lookup per press.
+        base = 12 * self.octave + NOTE_OFFSET
+        self._active = tuple(samples[base + c] if 0 <= base + c < len(samples) else None
+                             for c in range(13))
 
     def handle_note(self, channel, pressed):
-        note_index = channel + (12 * self.octave) + NOTE_OFFSET
-        if note_index >= 0 and note_index < len(samples) and pressed:
-            print('Playing Sound {}'.format(files[note_index]))
-            samples[note_index].play(loops=0)
+        sample = self._active[channel]
+        if pressed and sample is not None:
+            CHANNELS[channel].play(sample)
+            log.debug('Playing key %s in octave %s', channel, self.octave)
 
     def handle_octave_up(self, channel, pressed):
         if pressed and self.octave < octaves:
             self.octave += 1
-            print('Selecting Octave {}'.format(self.octave))
+            self._build_sample_map()
+            log.debug('Selecting Octave %s', self.octave)
 
     def handle_octave_down(self, channel, pressed):
         if pressed and self.octave > 0:
             self.octave -= 1
-            print('Selecting Octave {}'.format(self.octave))
+            self._build_sample_map()
+            log.debug('Selecting Octave %s', self.octave)
 
 
 class MelodyMode(PianoMode):
@@ -130,6 +206,7 @@ class MelodyMode(PianoMode):
                  easter_egg=None, octave=4, transpose=0):
         self.name = name
         self.melody = melodies[melody]
+        self._melody_len = len(self.melody)
         if easter_egg:
             self.play_on_success = os.path.join(BANK, easter_egg)
         else:
@@ -138,77 +215,112 @@ class MelodyMode(PianoMode):
         # use 'transpose' to transpose as necessary.
         self.note_offset = 12*octave + transpose + NOTE_OFFSET
 
+    # Path of the track currently loaded into the (single) music channel,
+    # shared between all MelodyMode instances.
+    _loaded_music = None
+
+    def _load_music(self):
+        if self.play_on_success and MelodyMode._loaded_music != self.play_on_success:
+            pygame.mixer.music.load(self.play_on_success)
+            MelodyMode._loaded_music = self.play_on_success
+
     def _success(self):
         if self.play_on_success:
-            pygame.mixer.music.load(self.play_on_success)
+            pygame.mixer.music.rewind()
             pygame.mixer.music.play()
-            self._music_running = True
-        turn_off_leds()
+        # Run the slow LED sweep off the callback thread, so keypresses
+        # keep being serviced while it plays out.
+        threading.Thread(target=self._success_animation, daemon=True).start()
+
+    def _success_animation(self):
+        pianohat.clear_leds()
         for led in range(13):
             pianohat.set_led(led, True)
             time.sleep(0.1)
-        turn_off_leds()
+        pianohat.clear_leds()
         time.sleep(2.0)
+        pianohat.set_led(self._expected_channel, True)
 
     def _next(self):
-        pianohat.set_led(self._current_note(), False)
-        time.sleep(0.1)
-        self.note += 1
-        if self.note == len(self.melody):
+        prev = self._expected_channel
+        self.note = (self.note + 1) % self._melody_len
+        current = self._expected_channel = self.melody[self.note]
+        log.debug('Advancing to note %s of %s', self.note, self._melody_len)
+        if self.note == 0:
+            # The success animation relights the first note when done.
             self._success()
-            self.note = 0
-        print('Advancing to note {} of {}'.format(self.note, len(self.melody)))
-        pianohat.set_led(self._current_note(), True)
-
-    def _current_note(self):
-        return self.melody[self.note]
+            return
+        if current == prev:
+            # Repeated note: blink off briefly so the advance is visible.
+            pianohat.set_led(prev, False)
+            threading.Timer(0.1, pianohat.set_led, (prev, True)).start()
+        else:
+            pianohat.set_led(current, True)
+            threading.Timer(0.1, pianohat.set_led, (prev, False)).start()
 
     def activate(self):
         super().activate()
         # 'activate' is called when changing modes. We assume that we
         # want to reset the melody on switching modes.
         self.note = 0
-        pianohat.set_led(self._current_note(), True)
+        # The next expected key is kept as a plain int so handle_note is
+        # a single compare, updated whenever the melody advances.
+        self._expected_channel = self.melody[0]
+        # Load the easter egg up front so _success doesn't block on disk I/O.
+        self._load_music()
+        pianohat.set_led(self._expected_channel, True)
 
     def handle_note(self, channel, pressed):
-        if not channel == self._current_note():
-            print('Wrong key pressed')
+        if channel != self._expected_channel:
+            log.debug('Wrong key pressed')
             return
         if pressed:
             note_index = self.note_offset + channel
-            print('Playing Sound {}'.format(files[note_index]))
-            samples[note_index].play(loops=0)
+            CHANNELS[channel].play(samples[note_index])
+            log.debug('Playing Sound %s', files[note_index])
             self._next()
 
     def handle_octave_up(self, channel, pressed):
         if self.play_on_success and pressed:
             pygame.mixer.music.unpause()
-            self._music_running = True
 
     def handle_octave_down(self, channel, pressed):
         if self.play_on_success and pressed:
-            if self._music_running:
+            # Ask SDL directly instead of shadowing its state in a flag
+            # that desyncs when the track ends on its own.
+            if pygame.mixer.music.get_busy():
                 pygame.mixer.music.pause()
-                self._music_running = False
             else:
                 pygame.mixer.music.stop()
 
 
+logging.basicConfig()
 print(start_message)
-pygame.mixer.pre_init(44100, -16, 1, 512)
-pygame.mixer.init()
+pygame.mixer.pre_init(44100, -16, 1, BUFFER_SAMPLES)
+pygame.mixer.init(buffer=BUFFER_SAMPLES)
 pygame.mixer.set_num_channels(16)
-turn_off_leds()
+CHANNELS = [pygame.mixer.Channel(i) for i in range(16)]
+pianohat.clear_leds()
 load_samples()
 opmodes = [SimplePianoMode(starting_octave=4),
            MelodyMode(name='Alle meine Entchen', melody='alle_meine_entchen'),
            MelodyMode(name='Zeiss-Sprung', melody='zeiss', transpose=6, easter_egg='mysterious.ogg')]
 # Register instrument button handling as this is a global key, independent of the mode class.
 pianohat.on_instrument(handle_instrument)
+# The other keys go through the dispatchers, so modes never re-register.
+pianohat.on_note(dispatch_note)
+pianohat.on_octave_up(dispatch_octave_up)
+pianohat.on_octave_down(dispatch_octave_down)
 # opmode_index is 0 by default.
 opmodes[opmode_index].activate()
+# Key handling happens on background threads; the main loop only has to
+# stay alive, so use its idle time for cheap young-generation collections
+# instead of risking a full stop-the-world GC mid-note.
+gc.disable()
 try:
-    signal.pause()
+    while True:
+        time.sleep(1.0)
+        gc.collect(0)
 except KeyboardInterrupt:
-    turn_off_leds()
+    pianohat.clear_leds()
     exit()
@@ -102,6 +102,30 @@ def set_led(index, state):
     else:
         _piano_ctog.set_led_state(index,state)
 
+def set_all_leds(states):
+    """Set all 16 LEDs with one write per chip
+
+    :param states: either a 16-bit number or a list of 16 True/False
+        values, with bit/index 0 being the first LED
+
+    Writes each chip's LED output register in a single transaction,
+    instead of one read-modify-write per LED as with set_led.
+
+    """
+
+    setup()
+
+    if not isinstance(states, int):
+        states = sum(1 << index for index, state in enumerate(states) if state)
+
+    _piano_ctog._write_byte(cap1xxx.R_LED_OUTPUT_CON, states & 0xff)
+    _piano_atoc._write_byte(cap1xxx.R_LED_OUTPUT_CON, (states >> 8) & 0xff)
+
+def clear_leds():
+    """Turn all 16 LEDs off with one write per chip"""
+
+    set_all_leds(0)
+
 def set_led_ramp_rate(rise,fall):
     """Set the time it takes an LED to turn on or off
 